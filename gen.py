@@ -8,189 +8,308 @@ from typing import Any, Mapping
 import json
 import subprocess
 import sys
-import xml.etree.ElementTree as ET
+
+try:
+    import lxml.etree as ET
+    # castxml output is trusted, indented and free of entities: skip the
+    # whitespace-only text nodes and libxml2's limits on huge documents.
+    ITERPARSE_OPTIONS = {
+        "remove_blank_text": True,
+        "resolve_entities": False,
+        "huge_tree": True,
+    }
+except ImportError:
+    import xml.etree.ElementTree as ET
+    ITERPARSE_OPTIONS = {}
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class Type:
+    __slots__ = ("id", "name", "type", "types", "_resolved", "_ffi_type")
+
     def __init__(self,
                  el,
-                 types: Mapping[str, Any],
+                 types: "TypeRegistry",
                  aliases: Mapping[str, str]):
-        self.el = el
+        self.id = el.get("id")
+        self.name = el.get("name")
+        self.type = el.get("type")
         self.types = types
-        self.aliases = aliases
+        self._resolved = None
+        self._ffi_type = None
 
     def resolve(self) -> str:
-        raise NotImplementedError
+        if self._resolved is None:
+            # Distinct nodes may spell the same C type (e.g. a struct and
+            # the elaborated type naming it); share one string for them.
+            self._resolved = sys.intern(self._resolve())
+        return self._resolved
 
     def resolve_ffi_type(self) -> str:
+        if self._ffi_type is None:
+            self._ffi_type = self._resolve_ffi_type()
+        return self._ffi_type
+
+    def _resolve(self) -> str:
+        raise NotImplementedError
+
+    def _resolve_ffi_type(self) -> str:
         raise NotImplementedError
 
 
 class Typedef(Type):
-    def resolve(self) -> str:
-        return self.el.get("name")
+    __slots__ = ()
 
-    def resolve_ffi_type(self) -> str:
-        return self.types[self.el.get("type")].resolve_ffi_type()
+    def _resolve(self) -> str:
+        return self.name
+
+    def _resolve_ffi_type(self) -> str:
+        return self.types.resolve_ffi_type(self.type)
 
 
 class PointerType(Type):
-    def resolve(self) -> str:
-        alias = self.aliases.get(self.el.get('id'))
-        if alias is not None:
-            return alias
+    __slots__ = ("alias",)
+
+    def __init__(self,
+                 el,
+                 types: "TypeRegistry",
+                 aliases: Mapping[str, str]):
+        super().__init__(el, types, aliases)
+        self.alias = aliases.get(self.id)
+
+    def _resolve(self) -> str:
+        if self.alias is not None:
+            return self.alias
         else:
-            return f"{self.types[self.el.get('type')].resolve()} *"
+            return f"{self.types.resolve(self.type)} *"
 
-    def resolve_ffi_type(self) -> str:
+    def _resolve_ffi_type(self) -> str:
         return "pointer"
 
 
 class FundamentalType(Type):
-    def resolve(self) -> str:
-        return self.el.get("name")
+    __slots__ = ("size",)
 
-    def resolve_ffi_type(self) -> str:
-        if self.el.get("size") == "8":
+    def __init__(self,
+                 el,
+                 types: "TypeRegistry",
+                 aliases: Mapping[str, str]):
+        super().__init__(el, types, aliases)
+        self.size = el.get("size")
+
+    def _resolve(self) -> str:
+        return self.name
+
+    def _resolve_ffi_type(self) -> str:
+        if self.size == "8":
             return "uchar"
-        elif self.el.get("size") == "64":
+        elif self.size == "64":
             return "ulong"
         else:
             raise NotImplementedError
 
 
 class CvQualifiedType(Type):
-    def resolve(self) -> str:
-        return f"const {self.types[self.el.get('type')].resolve()}"
+    __slots__ = ()
+
+    def _resolve(self) -> str:
+        return f"const {self.types.resolve(self.type)}"
 
 
 class ElaboratedType(Type):
-    def resolve(self) -> str:
-        keyword = self.el.get("keyword")
-        if keyword == "struct":
-            return self.types[self.el.get('type')].resolve()
+    __slots__ = ("keyword",)
+
+    def __init__(self,
+                 el,
+                 types: "TypeRegistry",
+                 aliases: Mapping[str, str]):
+        super().__init__(el, types, aliases)
+        self.keyword = el.get("keyword")
+
+    def _resolve(self) -> str:
+        if self.keyword == "struct":
+            return self.types.resolve(self.type)
         else:
             raise NotImplementedError
 
 
 class ArrayType(Type):
-    def resolve(self) -> str:
-        return (f"{self.types[self.el.get('type')].resolve()}"
-                f"[{int(self.el.get('max')) + 1}]")
+    __slots__ = ("max",)
+
+    def __init__(self,
+                 el,
+                 types: "TypeRegistry",
+                 aliases: Mapping[str, str]):
+        super().__init__(el, types, aliases)
+        self.max = el.get("max")
+
+    def _resolve(self) -> str:
+        return (f"{self.types.resolve(self.type)}"
+                f"[{int(self.max) + 1}]")
 
 
 class Field(Type):
+    __slots__ = ()
+
     def to_json(self) -> Mapping[str, Any]:
-        obj = {}
-        obj["name"] = self.el.get("name")
-        obj["type"] = self.types[self.el.get("type")].resolve()
-        return obj
+        return {
+            "name": self.name,
+            "type": self.types.resolve(self.type),
+        }
     
 
 class Struct(Type):
+    __slots__ = ("alias", "members")
+
     def __init__(self,
                  el,
-                 types: Mapping[str, Type],
+                 types: "TypeRegistry",
                  aliases: Mapping[str, str]):
         super().__init__(el, types, aliases)
+        self.alias = aliases.get(self.id)
         self.members = []
 
-    def resolve(self) -> str:
-        alias = self.aliases.get(self.el.get('id'))
-        if alias is not None:
-            return alias
+    def _resolve(self) -> str:
+        if self.alias is not None:
+            return self.alias
         else:
-            return f"struct {self.el.get('name')}"
+            return f"struct {self.name}"
 
     def to_json(self) -> Mapping[str, Any]:
-        obj = {}
-        alias = self.aliases.get(self.el.get('id'))
-        if alias is not None:
-            obj["name"] = alias
-        else:
-            obj["name"] = self.el.get("name")
-        obj["members"] = self.members
-        return obj
+        return {
+            "name": self.alias if self.alias is not None else self.name,
+            "members": [member.to_json() for member in self.members],
+        }
 
 
 class FunctionType(Type):
-    pass
+    __slots__ = ()
+
+
+TYPE_CLASSES = {
+    "Typedef": Typedef,
+    "PointerType": PointerType,
+    "FundamentalType": FundamentalType,
+    "ElaboratedType": ElaboratedType,
+    "CvQualifiedType": CvQualifiedType,
+    "ArrayType": ArrayType,
+    "FunctionType": FunctionType,
+    "Struct": Struct,
+}
+
+
+class TypeRegistry:
+    """Type wrappers keyed by castxml id, created on first reference.
+
+    Wrappers are only created once parsing is done and the aliases map is
+    complete, so they can look up their alias when they are constructed.
+    """
+
+    def __init__(self, aliases: Mapping[str, str]):
+        self.aliases = aliases
+        self.elements = {}
+        self._types = {}
+
+    def add(self, el):
+        self.elements[el.get("id")] = el
+
+    def get(self, type_id: str) -> Type:
+        type_ = self._types.get(type_id)
+        if type_ is None:
+            el = self.elements.pop(type_id)
+            type_ = TYPE_CLASSES[el.tag](el, self, self.aliases)
+            self._types[type_id] = type_
+        return type_
 
+    def resolve(self, type_id: str) -> str:
+        return self.get(type_id).resolve()
 
-TYPES = [
-    "Typedef",
-    "PointerType",
-    "FundamentalType",
-    "ElaboratedType",
-    "CvQualifiedType",
-    "ArrayType",
-    "FunctionType",
-    "Struct",
-]
+    def resolve_ffi_type(self, type_id: str) -> str:
+        return self.get(type_id).resolve_ffi_type()
 
 
 class Function(Type):
+    __slots__ = ("file", "returns", "arguments", "version")
+
     def __init__(self,
                  el,
-                 types: Mapping[str, Type],
+                 types: "TypeRegistry",
                  aliases: Mapping[str, str]):
         super().__init__(el, types, aliases)
+        self.file = el.get("file")
+        self.returns = el.get("returns")
+        self.arguments = [(arg.get("type"), arg.get("name"))
+                          for arg in el.findall("Argument")]
         self.version = 2
 
     def to_json(self) -> Mapping[str, Any]:
-        obj = {}
-        obj["name"] = self.el.get("name")
-        obj["version"] = self.version
-        returns = self.el.get("returns")
-        obj["returns"] = self.types[returns].resolve()
-        obj["arguments"] = []
-        for arg in self.el.iter("Argument"):
-            obj["arguments"].append({
-                "type": self.types[arg.get("type")].resolve(),
-                "name": arg.get("name"),
-                "ffi-type": self.types[arg.get("type")].resolve_ffi_type(),
+        types = self.types
+        arguments = []
+        for type_id, name in self.arguments:
+            type_ = types.get(type_id)
+            arguments.append({
+                "type": type_.resolve(),
+                "name": name,
+                "ffi-type": type_.resolve_ffi_type(),
             })
-        return obj
-
-
-class Encoder(json.JSONEncoder):
-    def default(self, obj):
-        if hasattr(obj, "to_json"):
-            return obj.to_json()
-        else:
-            return super().default(obj)
+        return {
+            "name": self.name,
+            "version": self.version,
+            "returns": types.resolve(self.returns),
+            "arguments": arguments,
+        }
 
 
 class AST:
-    def __init__(self, root):
-        self.root = root
-        types = {}
+    def __init__(self, source):
+        self._fields_by_id = {}
+        self._file_names = {}
+        self._structs_by_name = {}
         aliases = {}
+        types = TypeRegistry(aliases)
         functions = {}
+        elaborated_types = []
+        structs = []
         self.structs = []
 
-        gil = self.root.find("./Function[@name='C_GetInterfaceList']")
-        self.origin = self.root.find(f'''./File[@id="{gil.get('file')}"]''')\
-                               .get("name")
-
-        for el in self.root.iter():
-            if el.tag not in TYPES:
-                continue
-            cls = getattr(sys.modules[__name__], el.tag)
-            if cls is None:
-                continue
-            types[el.get("id")] = cls(el, types, aliases)
-
-        for el in self.root.iter("Typedef"):
-            aliases[el.get("type")] = el.get("name")
-
-        for el in self.root.iter("ElaboratedType"):
+        for _, el in ET.iterparse(source, **ITERPARSE_OPTIONS):
+            if el.tag in TYPE_CLASSES:
+                types.add(el)
+            if el.tag == "Typedef":
+                aliases[el.get("type")] = el.get("name")
+            elif el.tag == "ElaboratedType":
+                elaborated_types.append(el)
+            elif el.tag == "Struct":
+                structs.append(el)
+                self._structs_by_name.setdefault(el.get("name"), el)
+            elif el.tag == "Function":
+                functions[el.get("name")] = Function(el, types, aliases)
+                el.clear()
+            elif el.tag == "Field":
+                self._fields_by_id[el.get("id")] = el
+            elif el.tag == "File":
+                self._file_names[el.get("id")] = el.get("name")
+                el.clear()
+            elif el.tag not in TYPE_CLASSES and el.get("id") is not None:
+                # Nothing refers to this declaration; release its
+                # attributes and children while castxml is still writing.
+                el.clear()
+
+        gil = functions["C_GetInterfaceList"]
+        self.origin = self._file_names[gil.file]
+
+        # Typedefs may follow the elaborated types they name, so
+        # propagate aliases only once all of them are known.
+        for el in elaborated_types:
             alias = aliases.get(el.get("id"))
             if alias is not None:
                 aliases[el.get("type")] = alias
 
-        for el in self.root.iter("Struct"):
+        for el in structs:
             if el.get("incomplete") == "1":
                 continue
 
@@ -198,20 +317,16 @@ class AST:
             if not name.startswith("CK_"):
                 continue
 
-            struct = Struct(el, types, aliases)
+            struct = types.get(el.get("id"))
 
             struct.members = [
-                Field(self.root.find(f"./Field[@id='{member}']"),
-                      types, aliases)
-                for member in el.get("members", "").split(" ")
+                Field(self._fields_by_id[member], types, aliases)
+                for member in el.get("members", "").split()
             ]
 
-            self.structs.append(struct)
+            self.structs.append(struct.to_json())
 
-        for el in self.root.iter("Function"):
-            functions[el.get("name")] = Function(el, types, aliases)
-
-        function_names2 = self.get_function_names(2)
+        function_names2 = frozenset(self.get_function_names(2))
         function_names3 = self.get_function_names(3)
 
         self.functions = []
@@ -221,39 +336,55 @@ class AST:
                 function.version = 3
             else:
                 function.version = 2
-            self.functions.append(function)
+            self.functions.append(function.to_json())
 
     def get_function_names(self, version):
         if version == 2:
-            struct = self.root.find("./Struct[@name='_CK_FUNCTION_LIST']")
+            struct = self._structs_by_name["_CK_FUNCTION_LIST"]
         else:
-            struct = self.root.find("./Struct[@name='_CK_FUNCTION_LIST_3_0']")
-        names = []
-        for member in struct.get("members").split(" ")[1:]:
-            el = self.root.find(f"./Field[@id='{member}']")
-            names.append(el.get("name"))
-        return names
+            struct = self._structs_by_name["_CK_FUNCTION_LIST_3_0"]
+        return [self._fields_by_id[member].get("name")
+                for member in struct.get("members").split()[1:]]
+
+
+def generate(infile: str, castxml_program: str) -> Mapping[str, Any]:
+    with subprocess.Popen([castxml_program,
+                           "--castxml-output=1", "-o", "-",
+                           infile],
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL) as castxml:
+        ast = AST(castxml.stdout)
+    return {
+        "comment": f"This file is automatically generated from {ast.origin}",
+        "license": "BSD-3-Clause",
+        "functions": ast.functions,
+        "structs": ast.structs,
+    }
 
 
 if __name__ == "__main__":
     import argparse
+    import concurrent.futures
+    import itertools
     parser = argparse.ArgumentParser()
-    parser.add_argument("infile", type=argparse.FileType("r"))
+    parser.add_argument("infile", type=argparse.FileType("r"), nargs="+")
     parser.add_argument("--castxml-program", required=False, default="castxml")
     parser.add_argument("-o", "--outfile", type=argparse.FileType("w"),
                         required=False, default=sys.stdout)
     args = parser.parse_args()
 
-    castxml = subprocess.run([args.castxml_program,
-                              "--castxml-output=1", "-o", "-",
-                              args.infile.name], capture_output=True)
-    root = ET.fromstring(castxml.stdout)
-    ast = AST(root)
-    args.outfile.write(json.dumps({
-        "comment": f"This file is automatically generated from {ast.origin}",
-        "license": "BSD-3-Clause",
-        "functions": ast.functions,
-        "structs": ast.structs,
-    },
-                                  cls=Encoder, indent=2))
+    if len(args.infile) == 1:
+        output = generate(args.infile[0].name, args.castxml_program)
+    else:
+        # Parsing is CPU bound, so process the headers in parallel.
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            output = list(executor.map(
+                generate,
+                [infile.name for infile in args.infile],
+                itertools.repeat(args.castxml_program)))
+    if orjson is not None:
+        args.outfile.write(
+            orjson.dumps(output, option=orjson.OPT_INDENT_2).decode())
+    else:
+        json.dump(output, args.outfile, indent=2)
     args.outfile.write("\n")